@@ -7,108 +7,559 @@ tc htb. Also adds a fixed latency using tc netem.
 Requires root privileges to run tc commands.
 """
 
+import contextlib
+import ctypes
+import ctypes.util
+import errno
+import os
+import re
 import subprocess
 import time
 import sys
-import csv
+import itertools
+import logging
+import math
 import signal
+import threading
+from array import array
+
+try:
+    from pyroute2 import IPRoute
+except ImportError:  # Optional, rate changes are sent through the tc batch process instead
+    IPRoute = None
+
+try:
+    import stapsdt
+except (ImportError, OSError):  # Optional (needs libstapsdt), the USDT probes below are then no-ops
+    stapsdt = None
+
+logger = logging.getLogger(__name__)
 
 # Setup
 DEFAULT_LATENCY_MS = "50ms"  # Default fixed latency to add
 DEFAULT_BURST_BYTES = 15000  # HTB burst buffer size (bytes)
+RATE_CHANGE_TOLERANCE = 0.01  # Rate changes smaller than this fraction of the current rate are not applied
+TC_HISTORY_LINES = 256  # Recently sent batch lines kept to tell which command a tc error report refers to
+TC_FAILED_RE = re.compile(r"Command failed .*:(\d+)$")  # tc -batch's report after each failed command
+# What tc reports when deleting a root qdisc that isn't there (older and newer kernels), not worth a warning
+TC_NOTHING_TO_DELETE = ("RTNETLINK answers: No such file or directory", "Cannot delete qdisc with handle of zero")
+# Batch line that tc rejects without touching the kernel; its failure report shows tc got through everything before it
+TC_MARKER = "netemu-marker"
+TC_WAIT_TIMEOUT_S = 10  # How long to wait for the tc batch process to catch up before carrying on regardless
+PRECISE_SLEEP_WINDOW_S = 0.005  # Final part of each sleep that is done with clock_nanosleep rather than the stop event
+TIMER_ABSTIME = 1  # clock_nanosleep flag, deadline is an absolute time
+STOP_SIGNALS = {signal.SIGINT, signal.SIGTERM}
 target_interface = None
+_tc_proc = None  # Long-lived `tc -batch -` process that commands are piped to
+_tc_reader = None  # Thread logging the tc batch process's stderr
+_tc_sent = {}  # Batch line number -> command line, for the last TC_HISTORY_LINES lines sent
+_tc_lines_sent = 0  # Number of lines written to the current tc batch process
+_tc_waiting = {}  # Batch line number of a marker -> event set once tc has reached it
+_ipr = None  # pyroute2 netlink socket used for rate changes, if available
+_ifindex = {}  # Interface name -> index, for netlink requests
+_change_templates = {}  # Interface name -> `class change` line for it, with a %d placeholder for the rate in kbit
+_stop_requested = threading.Event()  # Set by the signal thread when playback should stop
+
+
+class _NoProbe:
+    """Stand-in for a stapsdt probe when USDT support isn't available; firing it does nothing."""
+    is_enabled = False
+
+    def fire(self, *args) -> bool:
+        return False
+
+
+# USDT probes in the "netemu" provider, replaced by real probes in register_probes
+_probe_provider = None
+_probe_tc_begin = _NoProbe()  # arg0: tc command line(s) about to be applied
+_probe_tc_end = _NoProbe()  # arg0: 1 if the change or any command of the batch failed, else 0
+_probe_sleep_begin = _NoProbe()  # arg0: planned sleep in microseconds
+_probe_sleep_end = _NoProbe()
+
+
+class _Timespec(ctypes.Structure):
+    """struct timespec, as taken by clock_nanosleep."""
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+
+def _load_clock_nanosleep():
+    """Returns libc's clock_nanosleep, or None if it is not available (e.g. not on Linux)."""
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        clock_nanosleep = libc.clock_nanosleep
+    except (OSError, AttributeError):
+        return None
+    clock_nanosleep.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(_Timespec), ctypes.POINTER(_Timespec)]
+    clock_nanosleep.restype = ctypes.c_int
+    return clock_nanosleep
+
 
+_clock_nanosleep = _load_clock_nanosleep()
 
-def run_tc_command(command: str) -> None:
-    """Executes a tc command using subprocess and handles errors."""
-    full_command = f"sudo tc {command}"
-    print(f"Executing: {full_command}")
+
+def sleep_until(deadline: float) -> None:
+    """
+    Sleeps until an absolute deadline, returning early if a stop is requested. Most of the time is spent waiting on the
+    stop event; the last PRECISE_SLEEP_WINDOW_S is slept on CLOCK_MONOTONIC with TIMER_ABSTIME on Linux, so the wake up
+    time doesn't depend on how long it took to compute the sleep duration. Elsewhere it falls back to time.sleep.
+
+    :param deadline: Time to wake up at, on the time.monotonic() clock.
+    """
+    coarse_duration = deadline - PRECISE_SLEEP_WINDOW_S - time.monotonic()
+    if coarse_duration > 0 and _stop_requested.wait(coarse_duration):
+        return
+
+    if _clock_nanosleep is not None:
+        seconds, fraction = divmod(deadline, 1)
+        request = _Timespec(int(seconds), int(fraction * 1_000_000_000))
+        # Returns the error number directly; retry if a signal interrupted the sleep
+        while _clock_nanosleep(time.CLOCK_MONOTONIC, TIMER_ABSTIME, ctypes.byref(request), None) == errno.EINTR:
+            pass
+        return
+
+    remaining = deadline - time.monotonic()
+    if remaining > 0:
+        time.sleep(remaining)
+
+
+def open_tc_batch() -> None:
+    """
+    Starts the long-lived tc batch process, replacing it if it has exited. Commands written to its stdin are executed
+    one per line, so no new process (or sudo authentication) is needed per command. -force keeps tc reading after a
+    failed command instead of exiting.
+    """
+    global _tc_proc, _tc_reader, _tc_sent, _tc_lines_sent, _tc_waiting
+    if _tc_proc is not None and _tc_proc.poll() is None:
+        return  # Already running
+    # When already running as root (the usual `sudo python3 ...`), run tc directly instead of through another sudo
+    argv = ["tc", "-force", "-batch", "-"] if os.geteuid() == 0 else ["sudo", "tc", "-force", "-batch", "-"]
+    logger.info("Starting tc batch process: %s", " ".join(argv))
+    with _stop_signals_unblocked():
+        _tc_proc = subprocess.Popen(argv, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                    text=True, bufsize=1)
+    # Line numbers in tc's error reports start again from 1 for the new process
+    _tc_sent = {}
+    _tc_lines_sent = 0
+    _tc_waiting = {}
+    _tc_reader = threading.Thread(target=_log_tc_errors, args=(_tc_proc.stderr, _tc_sent, _tc_waiting), daemon=True)
+    _tc_reader.start()
+
+
+def close_tc_batch() -> None:
+    """Closes the tc batch process's stdin and waits for it to execute the remaining commands and exit."""
+    global _tc_proc, _tc_reader
+    if _tc_proc is None:
+        return
     try:
-        # Use check=False initially to see if commands run without erroring out immediately
-        result = subprocess.run(full_command, shell=True, capture_output=True, text=True)
-        if result.returncode != 0:
+        _tc_proc.stdin.close()
+    except BrokenPipeError:
+        pass  # tc already exited
+    _tc_proc.wait()
+    _tc_reader.join()  # Let it log whatever tc reported last
+    _tc_proc = None
+    _tc_reader = None
+
+
+def _log_tc_errors(stderr, sent: dict[int, str], waiting: dict[int, threading.Event]) -> None:
+    """
+    Runs in a daemon thread for the lifetime of a tc batch process, logging errors as tc reports them, so sending a
+    command never has to wait to find out whether it failed. tc reports each failure as the error message followed by
+    "Command failed -:<line>", which is used to look up the failed command. The thread must keep reading until tc
+    exits, otherwise tc blocks once the stderr pipe is full and stops executing commands.
+
+    :param stderr: The tc batch process's stderr.
+    :param sent: Batch line number -> command line of recently sent commands, filled in by send_tc_lines. It is only
+        looked up by key here, never iterated, since the main thread adds to it concurrently.
+    :param waiting: Batch line number of a marker -> event to set once tc reports it, filled in by send_tc_lines.
+    """
+    message = []
+    failed = False  # Whether a command failed since the last marker
+    for line in stderr:
+        try:
+            line = line.rstrip("\n")
+            match = TC_FAILED_RE.search(line)
+            if match is None:
+                message.append(line)
+                continue
+            number = int(match.group(1))
+            command = sent.get(number, f"<batch line {number}>")
+            stderr_text = "\n".join(message)
+            message = []
+            if command == TC_MARKER:
+                # tc has executed the batch before the marker, which is when it's done as far as the probe goes
+                _probe_tc_end.fire(1 if failed else 0)
+                failed = False
+                reached = waiting.pop(number, None)
+                if reached is not None:
+                    reached.set()
+                continue
+            if command.startswith("qdisc del") and any(expected in stderr_text for expected in TC_NOTHING_TO_DELETE):
+                continue  # Ignore errors deleting a configuration that doesn't exist
+            failed = True
             # Print errors but don't raise immediately unless it's critical
-            print(f"Warning/Error executing tc command: {command}")
-            print(f"Return Code: {result.returncode}")
-            print(f"Stderr: {result.stderr}")
-            print(f"Stdout: {result.stdout}")
-            # Allow deletion errors to pass more easily
-            if "delete" in command and (
-                    "RTNETLINK answers: No such file or directory" in result.stderr or
-                    "Cannot find device" in result.stderr):
-                pass  # Ignore errors deleting non-existent things
-    except Exception as e:
-        print(f"Critical error running subprocess: {e}")
-        raise
+            logger.warning("Warning/Error executing tc command: %s\nStderr: %s", command, stderr_text)
+        except Exception:
+            logger.exception("Error reporting tc output: %s", line)
+    if message:
+        logger.warning("Stderr: %s", "\n".join(message))
+    # tc has exited, nothing it hasn't reached yet will ever be
+    while waiting:
+        waiting.popitem()[1].set()
+
+
+def register_probes() -> None:
+    """
+    Registers the netemu USDT probes if python-stapsdt is installed, so that a tracer (e.g. bpftrace) can time each tc
+    command and sleep of a running playback. Probes that no tracer is attached to cost next to nothing to fire.
+    """
+    global _probe_provider, _probe_tc_begin, _probe_tc_end, _probe_sleep_begin, _probe_sleep_end
+    if stapsdt is None:
+        return
+    provider = stapsdt.Provider("netemu")
+    tc_begin = provider.add_probe("tc_cmd_begin", stapsdt.ArgTypes.uint64)
+    tc_end = provider.add_probe("tc_cmd_end", stapsdt.ArgTypes.int32)
+    sleep_begin = provider.add_probe("sleep_begin", stapsdt.ArgTypes.uint64)
+    sleep_end = provider.add_probe("sleep_end")
+    if not provider.load():
+        logger.warning("Warning: could not load USDT probes")
+        return
+    logger.info("USDT probes registered (provider netemu, pid %d)", os.getpid())
+    # The provider has to stay referenced, its probes are destroyed with it
+    _probe_provider = provider
+    _probe_tc_begin, _probe_tc_end, _probe_sleep_begin, _probe_sleep_end = tc_begin, tc_end, sleep_begin, sleep_end
+
+
+def open_netlink() -> None:
+    """
+    Opens a netlink socket for rate changes if pyroute2 is installed and we are running as root. Rate changes then go
+    straight to the kernel instead of through tc; otherwise they keep using the tc batch process.
+    """
+    global _ipr
+    if IPRoute is None or os.geteuid() != 0:
+        logger.info("Sending rate changes through tc")
+        return
+    logger.info("Sending rate changes over netlink (pyroute2)")
+    _ipr = IPRoute()
+
+
+def close_netlink() -> None:
+    """Closes the netlink socket opened by open_netlink, if any."""
+    global _ipr
+    if _ipr is not None:
+        _ipr.close()
+        _ipr = None
+    _ifindex.clear()
+
+
+def refresh_sudo() -> None:
+    """
+    Validates (and caches) sudo credentials up front so the tc batch process does not have to prompt for them. Not
+    needed when already running as root, since tc is then run without sudo.
+    """
+    if os.geteuid() == 0:
+        return
+    with _stop_signals_unblocked():
+        result = subprocess.run(["sudo", "-v"])
+    if result.returncode != 0:
+        logger.warning("Warning: sudo -v failed with return code %d", result.returncode)
 
 
-def cleanup_tc(signum: int = None, frame: int = None) -> None:
+def run_tc_command(command: list[str]) -> None:
     """
-    Removes the tc qdisc configuration on exit. Parameters are to make it compatible with signal handling yet are
-    not used.
+    Sends a tc command to the tc batch process and handles errors.
 
-    :param signum: Signal number (optional).
-    :param frame: Current stack frame (optional).
+    :param command: tc arguments as a list of tokens, e.g. ["qdisc", "del", "dev", "eth0", "root"].
     """
+    run_tc_commands([command])
+
+
+def run_tc_commands(commands: list[list[str]], wait: bool = False) -> None:
+    """
+    Sends several tc commands to the tc batch process in a single write and handles errors.
+
+    :param commands: tc commands, each a list of tokens as taken by run_tc_command.
+    :param wait: Whether to wait until tc has executed them, as taken by send_tc_lines.
+    """
+    send_tc_lines([" ".join(command) for command in commands], wait)
+
+
+def send_tc_lines(command_lines: list[str], wait: bool = False) -> None:
+    """
+    Sends already formatted tc command lines to the tc batch process in a single write. Errors are logged as tc reports
+    them, without waiting here unless asked to.
+
+    :param command_lines: tc commands, each a complete batch line without the leading "tc" or trailing newline.
+    :param wait: Whether to wait (up to TC_WAIT_TIMEOUT_S) until tc has executed the commands, e.g. before changing
+        what they set up by other means. A marker line is sent after them, which tc reports back once it gets there.
+        The marker is also sent while a tracer is attached to tc_cmd_end, which then fires when tc reports it.
+    """
+    global _tc_lines_sent
+    for command_line in command_lines:
+        logger.debug("Executing: tc %s", command_line)
+    if _probe_tc_begin.is_enabled:
+        _probe_tc_begin.fire("\n".join(command_lines))
+    marked = wait or _probe_tc_end.is_enabled
+    batch_lines = command_lines + [TC_MARKER] if marked else command_lines
+    batch = "".join(command_line + "\n" for command_line in batch_lines)
+    for attempt in range(2):
+        try:
+            open_tc_batch()
+            for command_line in batch_lines:
+                _tc_lines_sent += 1
+                _tc_sent[_tc_lines_sent] = command_line
+                _tc_sent.pop(_tc_lines_sent - TC_HISTORY_LINES, None)
+            if wait:
+                # Registered before writing, so the reader can't see the marker before knowing what to do with it
+                reached = _tc_waiting[_tc_lines_sent] = threading.Event()
+            _tc_proc.stdin.write(batch)
+            _tc_proc.stdin.flush()
+            break
+        except BrokenPipeError:
+            # tc exited (e.g. killed by a Ctrl+C from the terminal) before we noticed; start a new one and retry once
+            if attempt:
+                logger.error("Critical error writing to tc batch process: tc exited again")
+                raise
+            _tc_proc.wait()
+        except Exception as e:
+            logger.error("Critical error writing to tc batch process: %s", e)
+            raise
+    # Errors are logged (and tc_cmd_end fired) by _log_tc_errors when tc reports them
+    if wait and not reached.wait(TC_WAIT_TIMEOUT_S):
+        logger.warning("Warning: tc batch process did not finish executing commands within %ds", TC_WAIT_TIMEOUT_S)
+
+
+def _handle_stop_signal(signum: int, frame=None) -> None:
+    """
+    Asks the playback loop to stop on the first SIGINT/SIGTERM. Playback is never interrupted mid-command; it notices
+    the request after its current sleep or change. A second signal exits straight away without cleanup, e.g. in case
+    cleanup hangs.
+
+    :param signum: Signal number.
+    :param frame: Current stack frame when called as a signal handler (not used).
+    """
+    name = signal.Signals(signum).name
+    if _stop_requested.is_set():
+        logger.warning("Received %s while already stopping, exiting without cleanup", name)
+        os._exit(128 + signum)
+    logger.info("Received %s, stopping playback...", name)
+    _stop_requested.set()
+
+
+def _wait_for_stop_signals() -> None:
+    """Runs in a daemon thread, handling SIGINT/SIGTERM (which are blocked in the main thread) as they arrive."""
+    while True:
+        _handle_stop_signal(signal.sigwait(STOP_SIGNALS))
+
+
+@contextlib.contextmanager
+def _stop_signals_unblocked():
+    """
+    Unblocks SIGINT/SIGTERM in the main thread while child processes are started, so that they don't inherit them
+    blocked. A signal arriving meanwhile goes to _handle_stop_signal as a regular signal handler.
+    """
+    old_mask = signal.pthread_sigmask(signal.SIG_UNBLOCK, STOP_SIGNALS)
+    try:
+        yield
+    finally:
+        signal.pthread_sigmask(signal.SIG_SETMASK, old_mask)
+
+
+def cleanup_tc() -> None:
+    """Removes the tc qdisc configuration on exit."""
     global target_interface
     if target_interface:
-        print(f"\nCleaning up tc configuration on {target_interface}...")
+        logger.info("Cleaning up tc configuration on %s...", target_interface)
         # Ignore errors if already cleaned up or never set
         try:
-            run_tc_command(f"qdisc del dev {target_interface} root")
-            print("Cleanup successful.")
+            run_tc_command(["qdisc", "del", "dev", target_interface, "root"])
+            close_tc_batch()
+            close_netlink()
+            logger.info("Cleanup successful.")
         except Exception as e:
-            print(f"Cleanup partially failed or qdisc already removed: {e}")
-    sys.exit(0)
+            logger.warning("Cleanup partially failed or qdisc already removed: %s", e)
 
 
-def apply_bandwidth_latency(interface: str, rate_kbps: int, latency_ms: str) -> None:
+def apply_bandwidth_latency(interface: str, rate_kbit: int, latency_ms: str) -> None:
     """
     Applies or changes the HTB rate AND adds netem latency.
 
     :param interface: Network interface to apply the settings to.
-    :param rate_kbps: Bandwidth limit in kbps.
+    :param rate_kbit: Bandwidth limit in kbit/s, as an int (as parsed by load_trace).
     :param latency_ms: Latency to apply (e.g., "50ms").
     """
     global target_interface
     target_interface = interface
 
-    rate_kbit = int(rate_kbps)
     burst_bytes = DEFAULT_BURST_BYTES
 
-    # Try deleting existing root qdisc first for a clean slate
-    run_tc_command(f"qdisc del dev {interface} root")
-    time.sleep(0.1)  # Short pause after deletion
-
-    # Add root HTB qdisc
-    run_tc_command(f"qdisc add dev {interface} root handle 1: htb default 10")
+    # Delete whatever is there first (e.g. left behind by a previous run that was killed) so setup always starts from a
+    # clean slate. It's part of the same batch: -force keeps tc going if there is nothing to delete, and the adds that
+    # follow are only read once the delete has completed. Rate changes over netlink don't go through tc, so when they
+    # are used wait for tc to finish setting up, or the first ones could reach the kernel before the class exists.
+    run_tc_commands([
+        ["qdisc", "del", "dev", interface, "root"],
+        # Add (or replace) root HTB qdisc
+        ["qdisc", "replace", "dev", interface, "root", "handle", "1:", "htb", "default", "10"],
+        # Add base HTB class with initial rate
+        ["class", "replace", "dev", interface, "parent", "1:", "classid", "1:1", "htb", "rate", f"{rate_kbit}kbit",
+         "burst", str(burst_bytes)],
+        # Add netem qdisc for latency under the HTB class 1:1
+        ["qdisc", "replace", "dev", interface, "parent", "1:1", "handle", "10:", "netem", "delay", latency_ms],
+        # Add filter to classify all IP traffic into the rate-limited class 1:1
+        ["filter", "add", "dev", interface, "parent", "1:", "protocol", "ip", "prio", "1", "u32", "match", "ip",
+         "src", "0.0.0.0/0", "match", "ip", "dst", "0.0.0.0/0", "flowid", "1:1"],
+    ], wait=_ipr is not None)
+
+    logger.info("Initial setup complete for %s: Rate=%dkbit, Latency=%s", interface, rate_kbit, latency_ms)
+
+
+def change_bandwidth(interface: str, rate_kbit: int) -> bool:
+    """
+    Changes the rate of the existing HTB class. Latency remains.
 
-    # Add base HTB class with initial rate
-    run_tc_command(f"class add dev {interface} parent 1: classid 1:1 htb rate {rate_kbit}kbit burst {burst_bytes}")
+    :param interface: Network interface to apply the settings to.
+    :param rate_kbit: New bandwidth limit in kbit/s, as an int (as parsed by load_trace).
+    :return: False if the change failed over netlink. Changes sent to the tc batch process aren't waited for, so they
+        count as successful once sent.
+    """
+    burst_bytes = DEFAULT_BURST_BYTES
+    # Only change the class rate, the netem qdisc attached to it remains.
+    if _ipr is not None:
+        if _probe_tc_begin.is_enabled:
+            _probe_tc_begin.fire(f"class change dev {interface} parent 1: classid 1:1 htb rate {rate_kbit}kbit burst "
+                                 f"{burst_bytes} (netlink)")
+        try:
+            if interface not in _ifindex:
+                _ifindex[interface] = _ipr.link_lookup(ifname=interface)[0]
+            _ipr.tc("change-class", "htb", _ifindex[interface], 0x10001, parent=0x10000, rate=f"{rate_kbit}kbit",
+                    burst=burst_bytes)
+        except Exception as e:
+            _probe_tc_end.fire(1)
+            # Print errors but don't raise, same as for tc commands
+            logger.warning("Warning/Error changing bandwidth over netlink: %s", e)
+            return False
+        _probe_tc_end.fire(0)
+    else:
+        # Everything but the rate is the same on every call, so build the command line once per interface
+        template = _change_templates.get(interface)
+        if template is None:
+            template = " ".join(["class", "change", "dev", interface, "parent", "1:", "classid", "1:1", "htb", "rate",
+                                 "%dkbit", "burst", str(burst_bytes)])
+            _change_templates[interface] = template
+        send_tc_lines([template % rate_kbit])
+    logger.debug("Changed bandwidth on %s to %dkbit", interface, rate_kbit)
+    return True
+
+
+def load_trace(trace_file: str) -> tuple[array, array]:
+    """
+    Parses and validates a trace file into two parallel arrays, skipping the header, comments and invalid rows
+    (including non-finite time offsets, which can't be scheduled, and rates too large to store). Arrays of plain numbers
+    are used instead of a list of rows to keep memory use low for long traces.
 
-    # Add netem qdisc for latency under the HTB class 1:1
-    run_tc_command(f"qdisc add dev {interface} parent 1:1 handle 10: netem delay {latency_ms}")
+    :param trace_file: File containing network trace to emulate.
+    :return: Time offsets in seconds (array of doubles) and throughputs in kbps (array of ints).
+    """
+    offsets = array('d')
+    rates = array('q')
+    skipped = 0
+    with open(trace_file) as f:
+        # Peek at the first line to handle a potential header, then stream the rest of the file
+        first_line = f.readline()
+        first_field = first_line.partition(',')[0].strip()
+        if first_field.startswith('#') or first_field.lower() == 'time (s)':
+            lines = f  # Skip header
+        else:
+            lines = itertools.chain([first_line], f)
+
+        # The trace is two plain numeric columns, so split lines directly rather than through csv.reader
+        for line in lines:
+            if line.isspace() or not line or line.startswith('#'):
+                continue  # Skip empty lines and comments in body
+
+            time_str, _, rest = line.partition(',')
+            rate_str = rest.partition(',')[0]
+            try:
+                time_offset = float(time_str)
+                throughput_kbps = int(rate_str)
+            except ValueError:
+                time_offset = math.nan
+
+            if math.isfinite(time_offset):
+                try:
+                    rates.append(throughput_kbps)
+                except OverflowError:
+                    pass  # Doesn't fit in an int64
+                else:
+                    offsets.append(time_offset)
+                    continue
 
-    # Add filter to classify all IP traffic into the rate-limited class 1:1
-    run_tc_command(
-        f"filter add dev {interface} parent 1: protocol ip prio 1 u32 match ip src 0.0.0.0/0 match ip dst "
-        f"0.0.0.0/0 flowid 1:1")
+            logger.warning("Skipping invalid row: %s", line.rstrip())
+            skipped += 1
 
-    print(f"Initial setup complete for {interface}: Rate={rate_kbit}kbit, Latency={latency_ms}")
+    logger.info("Loaded %d trace rows (%d invalid rows skipped)", len(offsets), skipped)
+    return offsets, rates
 
 
-def change_bandwidth(interface: str, rate_kbps: int) -> None:
+def _playback(interface: str, latency: str, offsets: array, rates: array) -> None:
     """
-    Changes the rate of the existing HTB class. Latency remains.
+    Plays back a parsed trace, applying each rate change at its time offset from the start of playback. Functions used
+    on every row are bound to locals first to save global lookups in the loop.
 
     :param interface: Network interface to apply the settings to.
-    :param rate_kbps: New bandwidth limit in kbps.
+    :param latency: Target latency in ms.
+    :param offsets: Time offsets in seconds, as returned by load_trace.
+    :param rates: Throughputs in kbps, as returned by load_trace.
     """
-    rate_kbit = int(rate_kbps)
-    burst_bytes = DEFAULT_BURST_BYTES
-    # Only change the class rate, the netem qdisc attached to it remains.
-    run_tc_command(f"class change dev {interface} parent 1: classid 1:1 htb rate {rate_kbit}kbit burst {burst_bytes}")
-    print(f"Changed bandwidth on {interface} to {rate_kbit}kbit")
+    monotonic = time.monotonic
+    sleep = sleep_until
+    stop_requested = _stop_requested.is_set
+    change = change_bandwidth
+    tolerance = RATE_CHANGE_TOLERANCE
+    probe_sleep_begin = _probe_sleep_begin
+    probe_sleep_end = _probe_sleep_end
+    debug = logger.debug
+
+    last_rate_kbps = None  # Rate currently applied to the interface
+    initial_rate_set = False
+    start_time = monotonic()
+
+    for time_offset, throughput_kbps in zip(offsets, rates):
+        # Sleep until the change is due. Deadlines are always relative to the start of playback so that
+        # time spent applying changes doesn't accumulate as drift.
+        deadline = start_time + time_offset
+        sleep_duration = deadline - monotonic()
+
+        if sleep_duration > 0:
+            debug("Sleeping for %.2f seconds...", sleep_duration)
+            probe_sleep_begin.fire(int(sleep_duration * 1_000_000))
+            sleep(deadline)
+            probe_sleep_end.fire()
+
+        if stop_requested():
+            break
+
+        if throughput_kbps < 0:
+            logger.info("End of trace signal received.")
+            break  # Exit loop if throughput is negative
+
+        if not initial_rate_set:
+            # Apply initial bandwidth AND latency
+            apply_bandwidth_latency(interface, throughput_kbps, latency)
+            initial_rate_set = True
+            last_rate_kbps = throughput_kbps
+        elif (throughput_kbps == last_rate_kbps or
+              abs(throughput_kbps - last_rate_kbps) < last_rate_kbps * tolerance):
+            # Rate is unchanged (or close enough), don't touch tc
+            debug("Keeping bandwidth at %dkbit (trace requests %dkbit)", last_rate_kbps, throughput_kbps)
+        else:
+            # Change bandwidth for subsequent entries (latency stays). If the change failed, the old rate is still
+            # applied, so keep comparing against it and retry at the next row
+            if change(interface, throughput_kbps):
+                last_rate_kbps = throughput_kbps
+
 
 def main(interface: str, trace_file: str, latency: str) -> None:
     """
@@ -118,87 +569,62 @@ def main(interface: str, trace_file: str, latency: str) -> None:
     :param trace_file: File containing network trace to emulate.
     :param latency: Target latency in ms.
     """
-    # Register signal handler for cleanup on Ctrl+C
-    signal.signal(signal.SIGINT, cleanup_tc)
-    signal.signal(signal.SIGTERM, cleanup_tc)
-
-    print(f"Starting bandwidth control on interface {interface}")
-    print(f"Using trace file: {trace_file}")
-    print(f"Applying fixed latency: {latency}")
-
-    start_time = time.time()
-    last_offset = 0
-    initial_rate_set = False
+    logger.info("Starting bandwidth control on interface %s", interface)
+    logger.info("Using trace file: %s", trace_file)
+    logger.info("Applying fixed latency: %s", latency)
 
+    # Parse and validate the whole trace before anything is set up, so a bad trace is rejected straight away and the
+    # playback loop only has to sleep and apply changes
     try:
-        with open(trace_file) as f:
-            reader = csv.reader(f)
-            rows_to_process = []
-            # Read all rows first to handle potential header properly
-            all_rows = list(reader)
-            if all_rows and (all_rows[0][0].strip().startswith('#') or all_rows[0][0].strip().lower() == 'time (s)'):
-                rows_to_process = all_rows[1:]  # Skip header
-            else:
-                rows_to_process = all_rows  # No header or first row is data
-
-            if not rows_to_process:
-                print("Error: Trace file is empty or contains only a header.")
-                sys.exit(1)
-
-            for row in rows_to_process:
-                if not row or (len(row) > 0 and row[0].strip().startswith('#')):
-                    continue  # Skip empty lines and comments in body
-
-                try:
-                    time_offset = float(row[0])
-                    throughput_kbps = int(row[1])
-                except (ValueError, IndexError):
-                    print(f"Skipping invalid row: {row}")
-                    continue
-
-                # Calculate time to sleep until the next change
-                current_time = time.time()
-                target_exec_time = start_time + time_offset
-                sleep_duration = target_exec_time - current_time
-
-                if sleep_duration > 0:
-                    print(f"Sleeping for {sleep_duration:.2f} seconds...")
-                    time.sleep(sleep_duration)
+        offsets, rates = load_trace(trace_file)
+    except FileNotFoundError:
+        logger.error("Error: Trace file not found at %s", trace_file)
+        sys.exit(1)
+    except (OSError, UnicodeDecodeError) as e:
+        logger.error("Error: Could not read trace file %s: %s", trace_file, e)
+        sys.exit(1)
+    if not offsets:
+        logger.error("Error: Trace file is empty or contains no valid rows.")
+        sys.exit(1)
 
-                if throughput_kbps < 0:
-                    print("End of trace signal received.")
-                    break  # Exit loop if throughput is negative
+    # Handle Ctrl+C and SIGTERM in a separate thread that asks the loop below to stop, so cleanup only happens in the
+    # finally block at the end. The signals must be blocked before the thread starts so that it inherits the mask. The
+    # regular handlers only run while the signals are briefly unblocked to start a child process.
+    for signum in STOP_SIGNALS:
+        signal.signal(signum, _handle_stop_signal)
+    signal.pthread_sigmask(signal.SIG_BLOCK, STOP_SIGNALS)
+    threading.Thread(target=_wait_for_stop_signals, daemon=True).start()
 
-                if not initial_rate_set:
-                    # Apply initial bandwidth AND latency
-                    apply_bandwidth_latency(interface, throughput_kbps, latency)
-                    initial_rate_set = True
-                else:
-                    # Change bandwidth for subsequent entries (latency stays)
-                    change_bandwidth(interface, throughput_kbps)
+    # Authenticate once now rather than from inside the tc batch process
+    refresh_sudo()
+    open_netlink()
+    register_probes()
 
-                last_offset = time_offset
-
-    except FileNotFoundError:
-        print(f"Error: Trace file not found at {trace_file}")
-        sys.exit(1)
+    try:
+        _playback(interface, latency, offsets, rates)
     except Exception as e:
-        print(f"An unexpected error occurred: {e}")
+        logger.error("An unexpected error occurred: %s", e)
     finally:
         # Ensure cleanup happens even if the script ends normally or via error
         cleanup_tc()
 
 
 if __name__ == "__main__":
+    # -v/--verbose logs every tc command and sleep; by default only setup, errors and the end of playback are logged
+    verbose = "-v" in sys.argv[1:] or "--verbose" in sys.argv[1:]
+    args = [arg for arg in sys.argv[1:] if arg not in ("-v", "--verbose")]
+
     # Re-add optional latency argument
-    if len(sys.argv) < 3 or len(sys.argv) > 4:
-        print("Usage: sudo python3 bandwidth_control.py <interface> <trace_file.csv> [latency_ms]")
+    if len(args) < 2 or len(args) > 3:
+        print("Usage: sudo python3 bandwidth_control.py [-v|--verbose] <interface> <trace_file.csv> [latency_ms]")
         print("Example: sudo python3 bandwidth_control.py s1-eth2 throughput_trace.csv 50")
         sys.exit(1)
 
-    interface = sys.argv[1]
-    trace_file = sys.argv[2]
+    logging.basicConfig(level=logging.DEBUG if verbose else logging.INFO, format="%(message)s")
+
+    interface = args[0]
+    trace_file = args[1]
     # Parse latency argument or use default
-    latency = sys.argv[3] + "ms" if len(sys.argv) == 4 else DEFAULT_LATENCY_MS
+    latency = args[2] + "ms" if len(args) == 3 else DEFAULT_LATENCY_MS
 
     main(interface, trace_file, latency)
@@ -7,6 +7,20 @@ Converts a CSV file with throughput data into the format taken by bandwidth_cont
 import sys
 
 
+def _to_kbps(value: bytes) -> int:
+    """
+    Converts one throughput value, as read from the input file, from Mbps to kbps.
+
+    :param value: raw input line holding the value in Mbps
+    :return: throughput in kbps
+    """
+    try:
+        return int(float(value) * 1000)
+    except ValueError:
+        # Convert the decoded text instead, so that the error shows the value as text rather than as bytes
+        return int(float(value.decode(errors='replace').strip()) * 1000)
+
+
 def convert(input_file: str, output_file: str) -> None:
     """
     Converts a CSV file with time and throughput data into the format taken by bandwidth_control.py.
@@ -14,25 +28,18 @@ def convert(input_file: str, output_file: str) -> None:
     :param input_file: input CSV file containing throughput data (Mbps) with time offset of one second per line
     :param output_file: output CSV file to write the converted data
     """
-    with open(input_file) as infile, open(output_file, 'w') as outfile:
-        # Write header to output file
-        outfile.write("# Time (s), Throughput (kbps)\n")
-
-        # Since the input file is expected to have one throughput value per line and each line represents one second,
-        # we can use a simple counter as the time offset.
-        counter = 0
-
-        for line in infile:
-            # Skip empty lines and comments
-            if not line.strip() or line.startswith('#') or line.startswith('UL'):
-                continue
-
-            throughput = int(float(line.strip()) * 1000)  # Convert to kbps
-            outfile.write(f"{counter},{throughput}\n")
-            counter += 1
-
-        infile.close()
-        outfile.close()
+    # Read raw bytes so lines can be filtered without decoding or stripping them; float() accepts bytes directly
+    with open(input_file, 'rb') as infile:
+        # Skip empty lines and comments, then convert every remaining value to kbps in one pass
+        throughputs = [_to_kbps(line) for line in infile if not line.isspace() and not line.startswith((b'#', b'UL'))]
+    counter = len(throughputs)
+
+    # Since the input file is expected to have one throughput value per line and each line represents one second,
+    # we can use the line index as the time offset. The whole file is built in memory and written with a single call.
+    out_lines = ["# Time (s), Throughput (kbps)"]
+    out_lines.extend(f"{offset},{throughput}" for offset, throughput in enumerate(throughputs))
+    with open(output_file, 'w') as outfile:
+        outfile.write("\n".join(out_lines) + "\n")
 
     print(f"Converted {input_file} to {output_file} successfully. The output file is ready for use with "
           f"bandwidth_control.py and has data for {counter} seconds ({(counter/60):.3f} minutes).")